@@ -1,15 +1,28 @@
 import functions_framework
+from flask import Response, stream_with_context
 from vertexai import rag
 from vertexai.generative_models import GenerativeModel, Tool
 import vertexai
 from google.cloud import storage
 from google.cloud import bigquery
+from google.api_core.exceptions import BadRequest, NotFound, PreconditionFailed
+import google.auth
+from google.auth.transport.requests import AuthorizedSession
+import requests
 import os
 import datetime
-import json
+import orjson
 import logging
 import yaml
 import re
+import textwrap
+import concurrent.futures
+import functools
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -20,6 +33,13 @@ LOCATION = None
 GEMINI_MODEL_NAME_STR = None
 RAG_RESOURCE_ID = None
 BQ_SQL_OUTPUT_BUCKET = None
+# Gemini 2.0 Flash caps output at 8,192 tokens, so longer inputs are translated in pieces.
+MAX_INPUT_CHARS = 30000
+# Identical SQL dry-run within this window reuses the earlier outcome instead of calling BigQuery.
+DRY_RUN_CACHE_TTL_SECONDS = 600
+# Part of every translation cache key; bump it to stop replaying translations, e.g. after the RAG
+# corpus content was re-imported.
+TRANSLATION_CACHE_VERSION = "1"
 
 try:
     with open('config.yaml', 'r') as file:
@@ -30,18 +50,24 @@ try:
     GEMINI_MODEL_NAME_STR = config.get("gemini_model_name_str")
     RAG_RESOURCE_ID = config.get("rag_resource_id") 
     BQ_SQL_OUTPUT_BUCKET = config.get("bq_sql_output_bucket")
-
-    logger.info(f"PROJECT_ID: {PROJECT_ID}")
-    logger.info(f"LOCATION: {LOCATION}")
-    logger.info(f"GEMINI_MODEL_NAME_STR: {GEMINI_MODEL_NAME_STR}")
-    logger.info(f"RAG_RESOURCE_ID (Corpus Name): {RAG_RESOURCE_ID}") 
-    logger.info(f"BQ_SQL_OUTPUT_BUCKET: {BQ_SQL_OUTPUT_BUCKET}")
+    MAX_INPUT_CHARS = config.get("max_input_chars", MAX_INPUT_CHARS)
+    DRY_RUN_CACHE_TTL_SECONDS = config.get("dry_run_cache_ttl_seconds", DRY_RUN_CACHE_TTL_SECONDS)
+    TRANSLATION_CACHE_VERSION = config.get("translation_cache_version", TRANSLATION_CACHE_VERSION)
+
+    logger.info("PROJECT_ID: %s", PROJECT_ID)
+    logger.info("LOCATION: %s", LOCATION)
+    logger.info("GEMINI_MODEL_NAME_STR: %s", GEMINI_MODEL_NAME_STR)
+    logger.info("RAG_RESOURCE_ID (Corpus Name): %s", RAG_RESOURCE_ID)
+    logger.info("BQ_SQL_OUTPUT_BUCKET: %s", BQ_SQL_OUTPUT_BUCKET)
+    logger.info("MAX_INPUT_CHARS: %s", MAX_INPUT_CHARS)
+    logger.info("DRY_RUN_CACHE_TTL_SECONDS: %s", DRY_RUN_CACHE_TTL_SECONDS)
+    logger.info("TRANSLATION_CACHE_VERSION: %s", TRANSLATION_CACHE_VERSION)
 
 except FileNotFoundError:
     logger.critical("Error: config.yaml not found. Please make sure the file exists.")
     raise FileNotFoundError("config.yaml not found. Cannot proceed.")
 except yaml.YAMLError as exc:
-    logger.critical(f"Error parsing YAML file: {exc}")
+    logger.critical("Error parsing YAML file: %s", exc)
     raise yaml.YAMLError(f"Error parsing YAML file: {exc}")
 
 if not PROJECT_ID:
@@ -50,234 +76,744 @@ if not PROJECT_ID:
 if not RAG_RESOURCE_ID:
     logger.critical("RAG_RESOURCE_ID not set from config. This is a critical configuration error.")
     raise ValueError("RAG_RESOURCE_ID is not set. Cannot proceed.")
-
+if isinstance(MAX_INPUT_CHARS, bool) or not isinstance(MAX_INPUT_CHARS, int) or MAX_INPUT_CHARS < 1:
+    logger.critical("MAX_INPUT_CHARS from config is not a positive integer: %r", MAX_INPUT_CHARS)
+    raise ValueError("max_input_chars must be a positive integer. Cannot proceed.")
+if isinstance(DRY_RUN_CACHE_TTL_SECONDS, bool) or not isinstance(DRY_RUN_CACHE_TTL_SECONDS, (int, float)) or DRY_RUN_CACHE_TTL_SECONDS < 0:
+    logger.critical("DRY_RUN_CACHE_TTL_SECONDS from config is not a non-negative number: %r", DRY_RUN_CACHE_TTL_SECONDS)
+    raise ValueError("dry_run_cache_ttl_seconds must be a non-negative number. Cannot proceed.")
+if isinstance(TRANSLATION_CACHE_VERSION, bool) or not isinstance(TRANSLATION_CACHE_VERSION, (str, int)):
+    logger.critical("TRANSLATION_CACHE_VERSION from config is not a string or integer: %r", TRANSLATION_CACHE_VERSION)
+    raise ValueError("translation_cache_version must be a string or integer. Cannot proceed.")
+
+
+# --- Batch Concurrency ---
+# Each file is dominated by network waits (GCS, Gemini, BigQuery), so threads overlap well.
+# The request's 'max_workers' sizes each pipeline stage's pool.
+DEFAULT_MAX_WORKERS = 10
+MAX_WORKERS_LIMIT = 16
+# urllib3 keeps 10 connections per host by default; size the pools so the download and publish
+# stages can each run MAX_WORKERS_LIMIT keep-alive connections instead of discarding sockets.
+HTTP_POOL_MAXSIZE = 2 * MAX_WORKERS_LIMIT
 
 # --- Global Client Initializations ---
-logger.info(f"Attempting to initialize Vertex AI for project: {PROJECT_ID}, location: {LOCATION}")
+def _pooled_http_session():
+    """Returns (credentials, session): an authorized HTTP session whose connection pool is sized for concurrent workers.
+
+    Clients given only _http skip resolving credentials themselves, so the credentials must be passed alongside.
+    """
+    credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
+    session = AuthorizedSession(credentials)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_MAXSIZE, pool_maxsize=HTTP_POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    return credentials, session
+
+
+logger.info("Attempting to initialize Vertex AI for project: %s, location: %s", PROJECT_ID, LOCATION)
 try:
     vertexai.init(project=PROJECT_ID, location=LOCATION)
     logger.info("Vertex AI initialized successfully.")
 except Exception as e:
-    logger.critical(f"FATAL: Failed to initialize Vertex AI SDK. Error: {type(e).__name__}: {e}", exc_info=True)
+    logger.critical("FATAL: Failed to initialize Vertex AI SDK. Error: %s: %s", type(e).__name__, e, exc_info=True)
     raise
 
 logger.info("Attempting to initialize Google Cloud Storage client.")
 try:
-    storage_client = storage.Client()
+    storage_credentials, storage_http = _pooled_http_session()
+    storage_client = storage.Client(credentials=storage_credentials, _http=storage_http)
     logger.info("Google Cloud Storage client initialized successfully.")
 except Exception as e:
-    logger.critical(f"FATAL: Failed to initialize GCS client. Error: {type(e).__name__}: {e}", exc_info=True)
+    logger.critical("FATAL: Failed to initialize GCS client. Error: %s: %s", type(e).__name__, e, exc_info=True)
     raise
 
 logger.info("Attempting to initialize Google BigQuery client.")
 try:
-    bigquery_client = bigquery.Client(project=PROJECT_ID)
+    bigquery_credentials, bigquery_http = _pooled_http_session()
+    bigquery_client = bigquery.Client(project=PROJECT_ID, credentials=bigquery_credentials, _http=bigquery_http)
     logger.info("Google BigQuery client initialized successfully.")
 except Exception as e:
-    logger.critical(f"FATAL: Failed to initialize BigQuery client. Error: {type(e).__name__}: {e}", exc_info=True)
+    logger.critical("FATAL: Failed to initialize BigQuery client. Error: %s: %s", type(e).__name__, e, exc_info=True)
     raise
 
+# --- Prompt ---
+# The SQL to translate is appended directly after this prefix.
+_PROMPT_PREFIX = textwrap.dedent("""\
+    Translate the following Databricks SQL to BigQuery SQL.
+    Ensure all functions, data types, and syntax are compatible with BigQuery.
+    Return ONLY the translated BigQuery SQL query, enclosed in triple backticks with the language identifier 'sql'.
+    For example:
+    ```sql
+    SELECT * FROM my_table;
+    ```
+    Databricks SQL to translate:
+    """)
+
+# --- Response Parsing ---
+_SQL_FENCE_RE = re.compile(r"```sql\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE)
+# Flattens log previews onto a single line.
+_NL_TO_SPACE = str.maketrans("\n\r", "  ")
+
+# --- Translation Cache ---
+TRANSLATION_CACHE_MAX_ENTRIES = 1024
+# Shared across instances: each new translation is written to <prefix><key>.sql in
+# BQ_SQL_OUTPUT_BUCKET, and a miss in memory looks there before calling Gemini. Cold starts load
+# nothing up front.
+TRANSLATION_CACHE_ENTRY_GCS_PREFIX = "_cache/entries/"
+# Entry uploads run in the background, but a batch waits up to this long for its own before the
+# response completes: Cloud Functions throttles CPU outside of requests.
+TRANSLATION_CACHE_WRITE_TIMEOUT_SECONDS = 10
+
+
+class TranslationCache:
+    """Thread-safe, exact-match LRU cache of BigQuery translations.
+
+    Entries are keyed on a SHA-256 of everything that shapes a translation: the fixed settings in
+    key_parts (model, RAG corpus, prompt, split size, cache version), the request's RAG top_k and
+    the Databricks SQL text. Changing any of them never replays translations produced under the
+    old settings.
+    """
+
+    def __init__(self, key_parts, entry_bucket=None, entry_writer=None, max_entries=TRANSLATION_CACHE_MAX_ENTRIES):
+        self._key_digest = hashlib.sha256(b"\0".join(str(part).encode("utf-8") for part in key_parts))
+        self._entry_bucket = entry_bucket
+        # Executor for entry uploads, so neither the translating caller nor its waiters block on GCS.
+        self._entry_writer = entry_writer
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def key_for(self, databricks_sql_content, rag_top_k):
+        digest = self._key_digest.copy()
+        digest.update(f"\0{rag_top_k}\0".encode("utf-8"))
+        digest.update(databricks_sql_content.encode("utf-8"))
+        return digest.hexdigest()
+
+    def put(self, key, bq_sql):
+        entry = {"bq_sql": bq_sql, "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+        with self._lock:
+            self._insert(key, entry)
+
+    def get_or_translate(self, key, translate_fn, pending_writes=None):
+        """Returns (bq_sql, reused) for key, calling translate_fn() only when nobody else can supply it.
+
+        translate_fn must return (bq_sql, cacheable). Callers that arrive while the same key is being
+        translated (duplicate files in one batch, or concurrent requests) wait for that single call
+        instead of issuing their own; reused is True for cache hits and for those waiters. The future
+        of a background entry upload is appended to pending_writes, if given.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry["bq_sql"], True
+            future = self._in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+
+        if not is_owner:
+            return future.result(), True
+
+        try:
+            bq_sql = self._fetch_entry(key)
+            if bq_sql is not None:
+                with self._lock:
+                    self._insert(key, {"bq_sql": bq_sql, "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat()})
+                future.set_result(bq_sql)
+                return bq_sql, True
+
+            bq_sql, cacheable = translate_fn()
+            if cacheable:
+                self.put(key, bq_sql)
+            future.set_result(bq_sql)
+            if cacheable and self._entry_bucket is not None:
+                if self._entry_writer is None:
+                    self._store_entry(key, bq_sql)
+                else:
+                    write_future = self._entry_writer.submit(self._store_entry, key, bq_sql)
+                    if pending_writes is not None:
+                        pending_writes.append(write_future)
+            return bq_sql, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def _fetch_entry(self, key):
+        if self._entry_bucket is None:
+            return None
+        try:
+            return self._entry_bucket.blob(f"{TRANSLATION_CACHE_ENTRY_GCS_PREFIX}{key}.sql").download_as_bytes().decode("utf-8")
+        except NotFound:
+            return None
+        except Exception as e:
+            # The shared tier is an optimization; fall back to translating.
+            logger.warning("Could not read translation cache entry %s from GCS: %s: %s", key, type(e).__name__, e)
+            return None
+
+    def _store_entry(self, key, bq_sql):
+        try:
+            self._entry_bucket.blob(f"{TRANSLATION_CACHE_ENTRY_GCS_PREFIX}{key}.sql").upload_from_string(bq_sql, content_type="text/plain")
+        except Exception as e:
+            logger.warning("Could not write translation cache entry %s to GCS: %s: %s", key, type(e).__name__, e)
+
+    def _insert(self, key, entry):
+        # Caller must hold self._lock.
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+# --- Dry Run Cache ---
+# Translation cache hits and duplicate files produce byte-identical SQL, whose dry run only changes
+# when a referenced table does. Successful outcomes are reused for DRY_RUN_CACHE_TTL_SECONDS.
+DRY_RUN_CACHE_MAX_ENTRIES = 1024
+_dry_run_cache = OrderedDict()
+_dry_run_cache_lock = threading.Lock()
+
+# Bucket handles are plain local objects; reuse them instead of rebuilding one per file.
+@functools.lru_cache(maxsize=32)
+def _get_bucket(bucket_name):
+    return storage_client.bucket(bucket_name)
+
+
+# Translations and translation cache entries always go to the same bucket.
+output_bucket = _get_bucket(BQ_SQL_OUTPUT_BUCKET) if BQ_SQL_OUTPUT_BUCKET else None
+# Shared by all requests so translated SQL uploads overlap the publish stage's dry runs.
+_upload_pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS_LIMIT, thread_name_prefix="upload")
+translation_cache = TranslationCache(
+    (GEMINI_MODEL_NAME_STR or "", RAG_RESOURCE_ID, _PROMPT_PREFIX, MAX_INPUT_CHARS, TRANSLATION_CACHE_VERSION),
+    entry_bucket=output_bucket,
+    entry_writer=_upload_pool,
+)
+
+
+# --- RAG Retrieval ---
+# Number of corpus contexts prepended to each prompt; requests may lower it via 'rag_top_k'.
+DEFAULT_RAG_TOP_K = 3
+RAG_TOP_K_LIMIT = 10
+
 rag_corpus_global = None
 rag_retrieval_tool_global = None
 gemini_rag_model_global = None 
+# Models for non-default top_k values, built on first use.
+_rag_models_by_top_k = {}
+
+
+def _build_rag_retrieval_tool(rag_top_k):
+    return Tool.from_retrieval(
+        retrieval=rag.Retrieval(
+            source=rag.VertexRagStore(
+                rag_resources=[
+                    rag.RagResource(
+                        rag_corpus=rag_corpus_global.name,
+                    )
+                ],
+                rag_retrieval_config=rag.RagRetrievalConfig(top_k=rag_top_k),
+            ),
+        )
+    )
+
+
+def _get_rag_model(rag_top_k):
+    """Returns the Gemini model whose RAG tool retrieves rag_top_k contexts."""
+    if rag_top_k == DEFAULT_RAG_TOP_K:
+        return gemini_rag_model_global
+    model = _rag_models_by_top_k.get(rag_top_k)
+    if model is None:
+        model = GenerativeModel(model_name=GEMINI_MODEL_NAME_STR, tools=[_build_rag_retrieval_tool(rag_top_k)])
+        model = _rag_models_by_top_k.setdefault(rag_top_k, model)
+    return model
+
 
 # --- RAG Resource Initialization Function ---
 def _initialize_rag_resources():
     global rag_corpus_global, rag_retrieval_tool_global, gemini_rag_model_global
 
     if rag_corpus_global and rag_retrieval_tool_global and gemini_rag_model_global:
-        logger.info("RAG resources and Gemini model already initialized. Skipping re-initialization.")
+        logger.debug("RAG resources and Gemini model already initialized. Skipping re-initialization.")
         return
 
     logger.info("Initializing RAG resources and Gemini model...")
     try:
         # Assuming RAG_RESOURCE_ID is the full corpus NAME, e.g., "projects/PROJECT_NUMBER/locations/LOCATION/ragCorpora/CORPUS_ID"
-        logger.info(f"Using RAG corpus: {RAG_RESOURCE_ID}")
+        logger.info("Using RAG corpus: %s", RAG_RESOURCE_ID)
         rag_corpus_global = rag.RagCorpus(name=RAG_RESOURCE_ID) 
 
-        rag_retrieval_config = rag.RagRetrievalConfig(top_k=3)
-        
-        rag_retrieval_tool_global = Tool.from_retrieval(
-            retrieval=rag.Retrieval(
-                source=rag.VertexRagStore(
-                    rag_resources=[
-                        rag.RagResource(
-                            rag_corpus=rag_corpus_global.name,
-                        )
-                    ],
-                    rag_retrieval_config=rag_retrieval_config,
-                ),
-            )
-        )
+        rag_retrieval_tool_global = _build_rag_retrieval_tool(DEFAULT_RAG_TOP_K)
         logger.info("RAG retrieval tool initialized successfully.")
 
         gemini_rag_model_global = GenerativeModel(
             model_name=GEMINI_MODEL_NAME_STR,
             tools=[rag_retrieval_tool_global]
         )
-        logger.info(f"Gemini model ({GEMINI_MODEL_NAME_STR}) with RAG tool initialized successfully.")
+        logger.info("Gemini model (%s) with RAG tool initialized successfully.", GEMINI_MODEL_NAME_STR)
 
     except Exception as e:
-        logger.critical(f"CRITICAL ERROR during RAG resource or Gemini model initialization: {type(e).__name__}: {e}", exc_info=True)
+        logger.critical("CRITICAL ERROR during RAG resource or Gemini model initialization: %s: %s", type(e).__name__, e, exc_info=True)
         raise
 
-# Ensure RAG resources are initialized once when the function container starts
+# Initialize RAG resources when the function container starts so the first request does not pay
+# for it. A failure is retried by the next request instead of taking the container down.
 try:
     _initialize_rag_resources()
 except Exception:
-    logger.critical("Pre-flight RAG resource initialization failed. Function will not be able to process requests.")
-    exit(1) 
+    logger.critical("Pre-flight RAG resource initialization failed. Deferring initialization to the first request.")
+
+
+def _prewarm_clients():
+    """Opens the Gemini and BigQuery connections at cold start so the first request does not pay for them."""
+    if gemini_rag_model_global is None:
+        logger.warning("Skipping Gemini pre-warm because the model is not initialized.")
+    else:
+        try:
+            # count_tokens goes through the same prediction endpoint and auth as generate_content, but is free.
+            gemini_rag_model_global.count_tokens("SELECT 1")
+            logger.info("Gemini model connection pre-warmed.")
+        except Exception as e:
+            logger.warning("Gemini pre-warm failed; the first request will open the connection. Error: %s: %s", type(e).__name__, e)
+
+    try:
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_legacy_sql=False)
+        bigquery_client.query("SELECT 1", job_config=job_config)
+        logger.info("BigQuery client connection pre-warmed.")
+    except Exception as e:
+        logger.warning("BigQuery pre-warm failed; the first dry run will open the connection. Error: %s: %s", type(e).__name__, e)
+
+
+_prewarm_clients()
+
+
+def _statement_end_offsets(sql):
+    """Yields the offset just past each line whose last code character is a statement-ending ';'.
+
+    Semicolons inside quoted strings or identifiers, '--' comments and '/* */' comments are ignored.
+    """
+    state = None  # None, the open quote character, "--" or "/*"
+    last_code_char = ""
+    i, length = 0, len(sql)
+    while i < length:
+        ch = sql[i]
+        if state is None:
+            if ch in "'\"`":
+                state = last_code_char = ch
+            elif sql.startswith("--", i):
+                state = "--"
+                i += 1
+            elif sql.startswith("/*", i):
+                state = "/*"
+                i += 1
+            elif ch == "\n":
+                if last_code_char == ";":
+                    yield i + 1
+                    last_code_char = ""
+            elif not ch.isspace():
+                last_code_char = ch
+        elif state == "--":
+            if ch == "\n":
+                state = None
+                if last_code_char == ";":
+                    yield i + 1
+                    last_code_char = ""
+        elif state == "/*":
+            if sql.startswith("*/", i):
+                state = None
+                i += 1
+        elif ch == "\\" and state != "`":
+            i += 1
+        elif ch == state:
+            state = None
+        i += 1
+
+
+def _split_sql_for_translation(databricks_sql_content, max_chars):
+    r"""Splits SQL into pieces of at most max_chars, cutting only after lines that end a statement.
+
+    A single statement longer than max_chars is kept whole rather than cut mid-statement, and a ';'
+    inside a string literal or comment never ends one:
+
+    >>> _split_sql_for_translation("INSERT INTO t VALUES ('line one;\nline two');\nSELECT 2;\n", 30)
+    ["INSERT INTO t VALUES ('line one;\nline two');\n", 'SELECT 2;\n']
+    >>> _split_sql_for_translation("SELECT 1 -- not the end;\nFROM t;\nSELECT 2;\n", 20)
+    ['SELECT 1 -- not the end;\nFROM t;\n', 'SELECT 2;\n']
+    >>> _split_sql_for_translation("SELECT 'a;\nb' /* c;\nd; */ FROM t", 10)
+    ["SELECT 'a;\nb' /* c;\nd; */ FROM t"]
+    """
+    if len(databricks_sql_content) <= max_chars:
+        return [databricks_sql_content]
+
+    statements, start = [], 0
+    for end in _statement_end_offsets(databricks_sql_content):
+        statements.append(databricks_sql_content[start:end])
+        start = end
+    if start < len(databricks_sql_content):
+        statements.append(databricks_sql_content[start:])
+
+    pieces, piece = [], ""
+    for statement in statements:
+        if piece and len(piece) + len(statement) > max_chars:
+            pieces.append(piece)
+            piece = ""
+        piece += statement
+    if piece:
+        pieces.append(piece)
+    return pieces
+
+
+def _translate_with_gemini(databricks_sql_gcs_p, databricks_sql_content, rag_top_k):
+    """Translates SQL text with the RAG-grounded Gemini model.
+
+    Inputs longer than MAX_INPUT_CHARS are translated statement-aligned piece by piece and the
+    results concatenated. Returns a (extracted_sql, sql_fenced) tuple; sql_fenced is False when
+    any model response had no ```sql block and the whole response was used as-is.
+    """
+    rag_model = _get_rag_model(rag_top_k)
+    pieces = _split_sql_for_translation(databricks_sql_content, MAX_INPUT_CHARS)
+    if len(pieces) > 1:
+        logger.info("Splitting %s into %s pieces of at most %s chars for translation.", databricks_sql_gcs_p, len(pieces), MAX_INPUT_CHARS)
+
+    translated_pieces = []
+    all_fenced = True
+    for piece in pieces:
+        extracted_sql, sql_fenced = _generate_bigquery_sql(databricks_sql_gcs_p, piece, rag_model)
+        translated_pieces.append(extracted_sql)
+        all_fenced = all_fenced and sql_fenced
+    return "\n\n".join(translated_pieces), all_fenced
+
+
+def _generate_bigquery_sql(databricks_sql_gcs_p, databricks_sql_content, rag_model):
+    """Runs one Gemini call and returns its (extracted_sql, sql_fenced) pair."""
+    prompt = _PROMPT_PREFIX + databricks_sql_content
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Sending prompt for %s (first 250 chars): '%s...'", databricks_sql_gcs_p, prompt[:250].translate(_NL_TO_SPACE))
+    response = rag_model.generate_content(prompt)
+
+    bq_sql_content_raw = ""
+    if hasattr(response, 'text'):
+        bq_sql_content_raw = response.text
+    else:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response object for %s does not have a 'text' attribute. Full response: %r", databricks_sql_gcs_p, response)
+        else:
+            logger.warning("Response object for %s does not have a 'text' attribute.", databricks_sql_gcs_p)
+        try:
+            bq_sql_content_raw = "".join(part.text for part in response.candidates[0].content.parts)
+        except Exception:
+            logger.error("Could not extract text from model response for %s. Defaulting to empty string.", databricks_sql_gcs_p)
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Raw SQL translation for %s (first 150 chars): '%s...'", databricks_sql_gcs_p, bq_sql_content_raw[:150].translate(_NL_TO_SPACE))
+
+    extracted_sql = bq_sql_content_raw
+    sql_match = _SQL_FENCE_RE.search(bq_sql_content_raw)
+    if sql_match:
+        extracted_sql = sql_match.group(1).strip()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Extracted SQL for %s (first 150 chars): '%s...'", databricks_sql_gcs_p, extracted_sql[:150].translate(_NL_TO_SPACE))
+    else:
+        logger.warning("SQL delimiter ```sql ... ``` not found in model response for %s. Using entire response.", databricks_sql_gcs_p)
+
+    return extracted_sql, sql_match is not None
+
+
+# --- Batch Pipeline Stages ---
+# Each file flows download -> translate -> publish (upload + dry run). Every stage has its own
+# thread pool, so one file's download overlaps another's Gemini call and a third's dry run.
+# A stage receives the previous stage's future; any exception travels down the chain and is
+# turned into the per-file error result by _collect_result().
+
+def _parse_gcs_path(gcs_path):
+    """Splits gs://bucket/object into (bucket, object) without intermediate string copies."""
+    slash = gcs_path.find("/", 5) if gcs_path.startswith("gs://") else -1
+    if slash <= 5 or slash == len(gcs_path) - 1:
+        raise ValueError(f"Invalid GCS path format: {gcs_path}")
+    return gcs_path[5:slash], gcs_path[slash + 1:]
+
+
+def _download_stage(databricks_sql_gcs_p):
+    """Reads one Databricks SQL file from GCS and returns the job dict for the later stages."""
+    logger.info("Processing SQL from GCS path: %s", databricks_sql_gcs_p)
+    input_bucket_name, input_blob_name = _parse_gcs_path(databricks_sql_gcs_p)
+
+    input_bucket = _get_bucket(input_bucket_name)
+    input_blob = input_bucket.blob(input_blob_name)
+
+    # No separate exists() check: the download itself reports a missing object.
+    try:
+        # SQL sources are UTF-8; decoding here skips download_as_text's charset detection, and a
+        # UnicodeDecodeError surfaces as ERROR_INVALID_INPUT.
+        databricks_sql_content = input_blob.download_as_bytes().decode("utf-8")
+    except NotFound:
+        raise FileNotFoundError(f"Input file not found: {databricks_sql_gcs_p}")
+    logger.info("Read SQL content (length: %s chars) for %s.", len(databricks_sql_content), databricks_sql_gcs_p)
+
+    return {
+        "input_gcs_path": databricks_sql_gcs_p,
+        "input_blob_name": input_blob_name,
+        "databricks_sql_content": databricks_sql_content,
+    }
+
+
+def _translate_stage(download_future, rag_top_k, cache_writes):
+    """Translates a downloaded file, serving repeated or duplicate SQL from the translation cache."""
+    job = download_future.result()
+    databricks_sql_gcs_p = job["input_gcs_path"]
+    # Taken out of the job dict: the download futures, and with them every job, live until the
+    # whole batch is done, so leaving it there would keep each input file in memory that long.
+    databricks_sql_content = job.pop("databricks_sql_content")
+
+    def translate():
+        extracted_sql, sql_fenced = _translate_with_gemini(databricks_sql_gcs_p, databricks_sql_content, rag_top_k)
+        # Only well-formed translations are worth replaying to later requests.
+        return extracted_sql, bool(sql_fenced and extracted_sql)
+
+    cache_key = translation_cache.key_for(databricks_sql_content, rag_top_k)
+    extracted_sql, reused = translation_cache.get_or_translate(cache_key, translate, cache_writes)
+    job["translation_cache_hit"] = reused
+    if reused:
+        logger.info("Reused translation for %s (key: %s). Skipped Gemini call.", databricks_sql_gcs_p, cache_key)
+
+    if not extracted_sql:
+        logger.info("Extracted SQL for %s is empty after extraction. Dry run will be skipped or fail.", databricks_sql_gcs_p)
+
+    job["extracted_sql"] = extracted_sql
+    return job
+
+
+def _publish_stage(translate_future, file_index, batch_timestamp, perform_dry_run):
+    """Uploads a translated file, optionally dry-runs it, and returns its per-file result dict."""
+    job = translate_future.result()
+    databricks_sql_gcs_p = job["input_gcs_path"]
+    extracted_sql = job["extracted_sql"]
+    file_result = {"input_gcs_path": databricks_sql_gcs_p, "translation_cache_hit": job["translation_cache_hit"]}
+
+    original_filename = os.path.basename(job["input_blob_name"])
+    output_filename_base = os.path.splitext(original_filename)[0]
+    # The batch index keeps same-named inputs from different folders from colliding.
+    output_blob_stem = f"translated_sql/{output_filename_base}_{batch_timestamp}_{file_index:04d}"
+
+    logger.info("Uploading extracted SQL for %s to gs://%s/%s_bq.sql", databricks_sql_gcs_p, BQ_SQL_OUTPUT_BUCKET, output_blob_stem)
+    # The upload and the dry run are independent; run the upload in the background meanwhile.
+    upload_future = _upload_pool.submit(_upload_translated_sql, output_blob_stem, extracted_sql)
+
+    dry_run_results = {}
+    if perform_dry_run:
+        try:
+            logger.info("Performing BigQuery dry run on extracted SQL for %s (length: %s chars)...", databricks_sql_gcs_p, len(extracted_sql))
+            if not extracted_sql.strip():
+                logger.warning("Extracted SQL for %s is empty or whitespace. Skipping dry run.", databricks_sql_gcs_p)
+                dry_run_results["status"] = "SKIPPED_EMPTY_SQL"
+                dry_run_results["reason"] = "Extracted SQL was empty."
+            else:
+                dry_run_results = _dry_run_sql(databricks_sql_gcs_p, extracted_sql)
+        except Exception as e_dry_run:
+            logger.error("BigQuery dry run for %s failed: %s: %s", databricks_sql_gcs_p, type(e_dry_run).__name__, e_dry_run, exc_info=True)
+            dry_run_results["status"] = "FAILURE"
+            dry_run_results["error_message"] = str(e_dry_run)
+    else:
+        logger.info("Dry run skipped for %s as per user request.", databricks_sql_gcs_p)
+        dry_run_results["status"] = "SKIPPED_BY_USER_REQUEST"
+
+    # Only report the path once the object exists; an upload failure fails the file.
+    output_blob_name = upload_future.result()
+    translated_gcs_path = f"gs://{BQ_SQL_OUTPUT_BUCKET}/{output_blob_name}"
+    file_result["translated_gcs_path"] = translated_gcs_path
+    logger.info("Extracted SQL for %s uploaded to: %s", databricks_sql_gcs_p, translated_gcs_path)
+
+    file_result["dry_run_results"] = dry_run_results
+    return file_result
+
+
+def _upload_translated_sql(output_blob_stem, extracted_sql):
+    """Uploads SQL to <stem>_bq.sql without ever overwriting an existing object; returns the blob name.
+
+    if_generation_match=0 lets GCS reject the write if the name is taken (e.g. two instances
+    handling batches in the same second), in which case a random suffix is added and retried once.
+    """
+    output_blob_name = f"{output_blob_stem}_bq.sql"
+    try:
+        output_bucket.blob(output_blob_name).upload_from_string(
+            extracted_sql, content_type="text/plain", if_generation_match=0)
+    except PreconditionFailed:
+        taken_name = output_blob_name
+        output_blob_name = f"{output_blob_stem}_{uuid.uuid4().hex[:8]}_bq.sql"
+        logger.warning("gs://%s/%s already exists; uploading to %s instead.", BQ_SQL_OUTPUT_BUCKET, taken_name, output_blob_name)
+        output_bucket.blob(output_blob_name).upload_from_string(
+            extracted_sql, content_type="text/plain", if_generation_match=0)
+    return output_blob_name
+
+
+def _dry_run_sql(databricks_sql_gcs_p, extracted_sql):
+    """Dry-runs SQL in BigQuery, reusing a recent outcome for identical SQL.
+
+    Only successes are cached. BadRequest rejections such as a missing table are what users fix and
+    re-run, so they are always checked again; any other error is raised.
+    """
+    cache_key = hashlib.sha256(extracted_sql.encode("utf-8")).hexdigest()
+    with _dry_run_cache_lock:
+        cached = _dry_run_cache.get(cache_key)
+    if cached is not None and time.monotonic() - cached[0] < DRY_RUN_CACHE_TTL_SECONDS:
+        logger.info("Reusing cached dry run outcome for %s: %s", databricks_sql_gcs_p, cached[1]['status'])
+        return {**cached[1], "cached": True}
+
+    try:
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_legacy_sql=False)
+        dry_run_job = bigquery_client.query(extracted_sql, job_config=job_config)
+        dry_run_results = {"status": "SUCCESS", "total_bytes_processed": dry_run_job.total_bytes_processed}
+        logger.info("Dry run for %s successful. Bytes processed: %s", databricks_sql_gcs_p, dry_run_job.total_bytes_processed)
+    except BadRequest as e_bad_request:
+        logger.error("BigQuery dry run for %s failed: %s: %s", databricks_sql_gcs_p, type(e_bad_request).__name__, e_bad_request)
+        return {"status": "FAILURE", "error_message": str(e_bad_request)}
+
+    with _dry_run_cache_lock:
+        _dry_run_cache[cache_key] = (time.monotonic(), dry_run_results)
+        _dry_run_cache.move_to_end(cache_key)
+        while len(_dry_run_cache) > DRY_RUN_CACHE_MAX_ENTRIES:
+            _dry_run_cache.popitem(last=False)
+    return dry_run_results
+
+
+def _collect_result(databricks_sql_gcs_p, publish_future):
+    """Waits for a file's pipeline to finish and maps any stage failure to an error result."""
+    try:
+        return publish_future.result()
+    except FileNotFoundError as e_file:
+        logger.error("File not found for %s: %s", databricks_sql_gcs_p, e_file)
+        return {"input_gcs_path": databricks_sql_gcs_p, "error": str(e_file), "status": "ERROR_FILE_NOT_FOUND"}
+    except ValueError as e_value:
+        logger.error("Input error for %s: %s", databricks_sql_gcs_p, e_value)
+        return {"input_gcs_path": databricks_sql_gcs_p, "error": str(e_value), "status": "ERROR_INVALID_INPUT"}
+    except RuntimeError as e_runtime:
+        logger.error("Runtime error processing %s: %s", databricks_sql_gcs_p, e_runtime, exc_info=True)
+        return {"input_gcs_path": databricks_sql_gcs_p, "error": str(e_runtime), "status": "ERROR_RUNTIME"}
+    except Exception as e_general:
+        logger.critical("Unhandled error processing %s: %s: %s", databricks_sql_gcs_p, type(e_general).__name__, e_general, exc_info=True)
+        return {
+            "input_gcs_path": databricks_sql_gcs_p,
+            "error": f"An unexpected error occurred: {str(e_general)}",
+            "status": "ERROR_UNHANDLED",
+        }
+
+
+def _iter_pipeline_results(databricks_sql_gcs_paths, perform_dry_run, max_workers, rag_top_k):
+    """Runs every file through the three stages, yielding (index, file_result) as each file finishes."""
+    # UTC, so names sort consistently across regions; same-second collisions are handled at upload.
+    batch_timestamp = time.strftime("%Y%m%d%H%M%S", time.gmtime())
+    cache_writes = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="download") as download_pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="translate") as translate_pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="publish") as publish_pool:
+        download_futures = [download_pool.submit(_download_stage, p) for p in databricks_sql_gcs_paths]
+        translate_futures = [translate_pool.submit(_translate_stage, f, rag_top_k, cache_writes) for f in download_futures]
+        publish_futures = [
+            publish_pool.submit(_publish_stage, f, i, batch_timestamp, perform_dry_run)
+            for i, f in enumerate(translate_futures)
+        ]
+        index_by_future = {f: i for i, f in enumerate(publish_futures)}
+        for publish_future in concurrent.futures.as_completed(index_by_future):
+            file_index = index_by_future[publish_future]
+            yield file_index, _collect_result(databricks_sql_gcs_paths[file_index], publish_future)
+
+    # All translate stages are done, so cache_writes is complete. Finish the uploads while the
+    # request is still active.
+    _, unfinished = concurrent.futures.wait(cache_writes, timeout=TRANSLATION_CACHE_WRITE_TIMEOUT_SECONDS)
+    if unfinished:
+        logger.warning("%s translation cache entry upload(s) still running after %ss.", len(unfinished), TRANSLATION_CACHE_WRITE_TIMEOUT_SECONDS)
+
+
+def _run_pipeline(databricks_sql_gcs_paths, perform_dry_run, max_workers, rag_top_k):
+    """Runs every file through the three stages and returns the results in input order."""
+    results = [None] * len(databricks_sql_gcs_paths)
+    for file_index, file_result in _iter_pipeline_results(databricks_sql_gcs_paths, perform_dry_run, max_workers, rag_top_k):
+        results[file_index] = file_result
+    return results
+
+
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+# Error responses carry fixed messages, so their JSON bodies are encoded once at import.
+_ERROR_MESSAGES = {
+    "missing_paths": "Missing 'databricks_sql_gcs_paths' (list of GCS file paths) in request.",
+    "paths_not_list": "'databricks_sql_gcs_paths' must be a list of strings.",
+    "paths_empty": "'databricks_sql_gcs_paths' list cannot be empty.",
+    "invalid_perform_dry_run": "'perform_dry_run' must be a boolean (true or false).",
+    "invalid_max_workers": "'max_workers' must be a positive integer.",
+    "invalid_rag_top_k": f"'rag_top_k' must be an integer between 1 and {RAG_TOP_K_LIMIT}.",
+    "invalid_stream_results": "'stream_results' must be a boolean (true or false).",
+    "model_not_initialized": "Server internal error: Model not initialized.",
+}
+_ERROR_BODIES = {key: orjson.dumps({"error": msg}) for key, msg in _ERROR_MESSAGES.items()}
+
+
+def _error_response(error_key, status):
+    logger.error(_ERROR_MESSAGES[error_key])
+    return _ERROR_BODIES[error_key], status, _JSON_HEADERS
+
+
+def _json_response(payload, status):
+    return orjson.dumps(payload), status, _JSON_HEADERS
+
 
 @functions_framework.http
 def translate_sql(request):
     logger.info("Received request to translate SQL.")
-    request_json = request.get_json(silent=True)
+    try:
+        request_json = orjson.loads(request.get_data(cache=False))
+    except orjson.JSONDecodeError:
+        request_json = None
 
-    if not request_json or "databricks_sql_gcs_paths" not in request_json:
-        msg = "Missing 'databricks_sql_gcs_paths' (list of GCS file paths) in request."
-        logger.error(msg)
-        return json.dumps({"error": msg}), 400
+    if not isinstance(request_json, dict) or "databricks_sql_gcs_paths" not in request_json:
+        return _error_response("missing_paths", 400)
 
     databricks_sql_gcs_paths = request_json["databricks_sql_gcs_paths"]
     if not isinstance(databricks_sql_gcs_paths, list) or not all(isinstance(p, str) for p in databricks_sql_gcs_paths):
-        msg = "'databricks_sql_gcs_paths' must be a list of strings."
-        logger.error(msg)
-        return json.dumps({"error": msg}), 400
-    
+        return _error_response("paths_not_list", 400)
+
     if not databricks_sql_gcs_paths:
-        msg = "'databricks_sql_gcs_paths' list cannot be empty."
-        logger.error(msg)
-        return json.dumps({"error": msg}), 400
+        return _error_response("paths_empty", 400)
 
     perform_dry_run = request_json.get("perform_dry_run", True)
     if not isinstance(perform_dry_run, bool):
-        msg = "'perform_dry_run' must be a boolean (true or false)."
-        logger.error(msg)
-        return json.dumps({"error": msg}), 400
+        return _error_response("invalid_perform_dry_run", 400)
     
-    logger.info(f"Batch processing requested. Perform dry run: {perform_dry_run}")
+    max_workers = request_json.get("max_workers", DEFAULT_MAX_WORKERS)
+    if isinstance(max_workers, bool) or not isinstance(max_workers, int) or max_workers < 1:
+        return _error_response("invalid_max_workers", 400)
+    max_workers = min(max_workers, MAX_WORKERS_LIMIT, len(databricks_sql_gcs_paths))
 
-    results = []
+    rag_top_k = request_json.get("rag_top_k", DEFAULT_RAG_TOP_K)
+    if isinstance(rag_top_k, bool) or not isinstance(rag_top_k, int) or not 1 <= rag_top_k <= RAG_TOP_K_LIMIT:
+        return _error_response("invalid_rag_top_k", 400)
 
-    if not gemini_rag_model_global:
-        logger.critical("Gemini RAG model not initialized. This indicates a critical startup failure.")
-        return json.dumps({"error": "Server internal error: Model not initialized."}), 500
+    stream_results = request_json.get("stream_results", False)
+    if not isinstance(stream_results, bool):
+        return _error_response("invalid_stream_results", 400)
 
-    for databricks_sql_gcs_p in databricks_sql_gcs_paths:
-        logger.info(f"Processing SQL from GCS path: {databricks_sql_gcs_p}")
-        file_result = {"input_gcs_path": databricks_sql_gcs_p}
+    logger.info("Batch processing requested. Perform dry run: %s, max workers per stage: %s, RAG top_k: %s, stream results: %s", perform_dry_run, max_workers, rag_top_k, stream_results)
 
-        try:
-            path_parts = databricks_sql_gcs_p.replace("gs://", "").split("/", 1)
-            if len(path_parts) < 2:
-                raise ValueError(f"Invalid GCS path format: {databricks_sql_gcs_p}")
-            input_bucket_name, input_blob_name = path_parts
-
-            input_bucket = storage_client.bucket(input_bucket_name)
-            input_blob = input_bucket.blob(input_blob_name)
-
-            if not input_blob.exists():
-                raise FileNotFoundError(f"Input file not found: {databricks_sql_gcs_p}")
-
-            databricks_sql_content = input_blob.download_as_text()
-            logger.info(f"Read SQL content (length: {len(databricks_sql_content)} chars) for {databricks_sql_gcs_p}.")
-
-            prompt = f"""\
-                    Translate the following Databricks SQL to BigQuery SQL.
-                    Ensure all functions, data types, and syntax are compatible with BigQuery.
-                    Return ONLY the translated BigQuery SQL query, enclosed in triple backticks with the language identifier 'sql'.
-                    For example:
-                    ```sql
-                    SELECT * FROM my_table;
-                    Databricks SQL to translate:
-                    {databricks_sql_content}
-                    """
-            truncated_prompt = prompt[:250].replace('\n', ' ')
-            logger.info(f"Sending prompt for {databricks_sql_gcs_p} (first 250 chars): '{truncated_prompt}...'")
-            response = gemini_rag_model_global.generate_content(prompt)
-
-            bq_sql_content_raw = ""
-            if hasattr(response, 'text'):
-                bq_sql_content_raw = response.text
-            else:
-                logger.warning(f"Response object for {databricks_sql_gcs_p} does not have a 'text' attribute. Full response: {response}")
-                try:
-                    bq_sql_content_raw = "".join(part.text for part in response.candidates[0].content.parts)
-                except Exception:
-                    logger.error(f"Could not extract text from model response for {databricks_sql_gcs_p}. Defaulting to empty string.")
-
-            raw_sql_truncated = bq_sql_content_raw[:150].replace('\n', ' ')
-            logger.info(f"Raw SQL translation for {databricks_sql_gcs_p} (first 150 chars): '{raw_sql_truncated}...'")
-
-
-            extracted_sql = bq_sql_content_raw
-            sql_match = re.search(r"```sql\s*(.*?)\s*```", bq_sql_content_raw, re.DOTALL | re.IGNORECASE)
-            if sql_match:
-                extracted_sql = sql_match.group(1).strip()
-                extracted_sql_truncated = extracted_sql[:150].replace('\n', ' ')
-                logger.info(f"Extracted SQL for {databricks_sql_gcs_p} (first 150 chars): '{extracted_sql_truncated}...'")
-            else:
-                logger.warning(f"SQL delimiter ```sql ... ``` not found in model response for {databricks_sql_gcs_p}. Using entire response.")
-
-            if not extracted_sql:
-                logger.info(f"Extracted SQL for {databricks_sql_gcs_p} is empty after extraction. Dry run will be skipped or fail.")
-            
-            timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-            original_filename = os.path.basename(input_blob_name)
-            output_filename_base = os.path.splitext(original_filename)[0]
-            output_blob_name = f"translated_sql/{output_filename_base}_{timestamp}_bq.sql"
-
-            output_bucket = storage_client.bucket(BQ_SQL_OUTPUT_BUCKET)
-            output_blob = output_bucket.blob(output_blob_name)
-
-            logger.info(f"Uploading extracted SQL for {databricks_sql_gcs_p} to gs://{BQ_SQL_OUTPUT_BUCKET}/{output_blob_name}")
-            output_blob.upload_from_string(extracted_sql, content_type="text/plain")
-            translated_gcs_path = f"gs://{BQ_SQL_OUTPUT_BUCKET}/{output_blob_name}"
-            file_result["translated_gcs_path"] = translated_gcs_path
-            logger.info(f"Extracted SQL for {databricks_sql_gcs_p} uploaded to: {translated_gcs_path}")
-
-            dry_run_results = {}
-            if perform_dry_run:
-                try:
-                    logger.info(f"Performing BigQuery dry run on extracted SQL for {databricks_sql_gcs_p} (length: {len(extracted_sql)} chars)...")
-                    if not extracted_sql.strip():
-                        logger.warning(f"Extracted SQL for {databricks_sql_gcs_p} is empty or whitespace. Skipping dry run.")
-                        dry_run_results["status"] = "SKIPPED_EMPTY_SQL"
-                        dry_run_results["reason"] = "Extracted SQL was empty."
-                    else:
-                        job_config = bigquery.QueryJobConfig(dry_run=True, use_legacy_sql=False)
-                        dry_run_job = bigquery_client.query(extracted_sql, job_config=job_config)
-                        dry_run_results["status"] = "SUCCESS"
-                        dry_run_results["total_bytes_processed"] = dry_run_job.total_bytes_processed
-                        logger.info(f"Dry run for {databricks_sql_gcs_p} successful. Bytes processed: {dry_run_job.total_bytes_processed}")
-                except Exception as e_dry_run:
-                    logger.error(f"BigQuery dry run for {databricks_sql_gcs_p} failed: {type(e_dry_run).__name__}: {e_dry_run}", exc_info=True)
-                    dry_run_results["status"] = "FAILURE"
-                    dry_run_results["error_message"] = str(e_dry_run)
-            else:
-                logger.info(f"Dry run skipped for {databricks_sql_gcs_p} as per user request.")
-                dry_run_results["status"] = "SKIPPED_BY_USER_REQUEST"
-
-            file_result["dry_run_results"] = dry_run_results
-
-        except FileNotFoundError as e_file:
-            logger.error(f"File not found for {databricks_sql_gcs_p}: {e_file}", exc_info=True)
-            file_result["error"] = str(e_file)
-            file_result["status"] = "ERROR_FILE_NOT_FOUND"
-        except ValueError as e_value:
-            logger.error(f"Input error for {databricks_sql_gcs_p}: {e_value}", exc_info=True)
-            file_result["error"] = str(e_value)
-            file_result["status"] = "ERROR_INVALID_INPUT"
-        except RuntimeError as e_runtime:
-            logger.error(f"Runtime error processing {databricks_sql_gcs_p}: {e_runtime}", exc_info=True)
-            file_result["error"] = str(e_runtime)
-            file_result["status"] = "ERROR_RUNTIME"
-        except Exception as e_general:
-            logger.critical(f"Unhandled error processing {databricks_sql_gcs_p}: {type(e_general).__name__}: {e_general}", exc_info=True)
-            file_result["error"] = f"An unexpected error occurred: {str(e_general)}"
-            file_result["status"] = "ERROR_UNHANDLED"
-
-        results.append(file_result)
-
-        logger.info(f"Batch processing complete. Processed {len(databricks_sql_gcs_paths)} file(s).")
-        return json.dumps(results), 200
+    try:
+        # No-op once the container's startup initialization has succeeded.
+        _initialize_rag_resources()
+    except Exception:
+        logger.critical("Gemini RAG model could not be initialized for this request.")
+        return _error_response("model_not_initialized", 500)
+
+    if stream_results:
+        # One JSON object per line, written as soon as each file finishes. Lines arrive in
+        # completion order, so each carries its position in databricks_sql_gcs_paths.
+        def generate_ndjson():
+            for file_index, file_result in _iter_pipeline_results(databricks_sql_gcs_paths, perform_dry_run, max_workers, rag_top_k):
+                yield orjson.dumps({"index": file_index, **file_result}) + b"\n"
+            logger.info("Batch processing complete. Streamed %s file result(s).", len(databricks_sql_gcs_paths))
+
+        return Response(stream_with_context(generate_ndjson()), status=200, mimetype="application/x-ndjson")
+
+    results = _run_pipeline(databricks_sql_gcs_paths, perform_dry_run, max_workers, rag_top_k)
+
+    logger.info("Batch processing complete. Processed %s file(s).", len(databricks_sql_gcs_paths))
+    return _json_response(results, 200)